@@ -1,26 +1,36 @@
-import copy
+import asyncio
 import hashlib
-import json
 import logging
 import os
 import pathlib
 import random
+import re
 import time
 import uuid
 from collections import deque
 from datetime import datetime
 from typing import List, Dict, Optional
+from urllib.parse import urlparse
 
 import httpx
-import redis
-from fastapi import FastAPI, Request, HTTPException, Depends, Security, status, Form
+import msgspec
+import orjson
+from redis.asyncio import Redis as AsyncRedis, ConnectionPool
+from fastapi import FastAPI, Request, Response, HTTPException, Depends, Security, status, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse, HTMLResponse, RedirectResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse, HTMLResponse, RedirectResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, Field
-from api.models import ModelRequestRecord
+from api.models import ModelRequestRecord, API_CONFIG_DECODER, API_CONFIGS_DECODER, MODEL_MAPPINGS_DECODER
+
+try:
+    # 优先使用基于libuv的uvloop事件循环，未安装时（如Windows）使用默认的asyncio事件循环
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 UNKNOWN = 'unknown'
 
@@ -31,10 +41,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger("uniapi")
 
+# 路由热路径上使用的函数，预先绑定到模块级名称，减少属性查找
+_choices = random.choices
+
 # 获取当前文件的目录
 BASE_DIR = pathlib.Path(__file__).parent.resolve()
 
-app = FastAPI(title="UniAPI - OpenAI API转发器")
+app = FastAPI(title="UniAPI - OpenAI API转发器", default_response_class=ORJSONResponse)
 
 # 断路器规则，连续失败的次数，对应降级的时间，如果某个模型连续失败达到指定次数
 # 会在最近的一次请求之后的x分钟内，直接降级，不再发起请求
@@ -48,6 +61,25 @@ fail_count_to_cooldown = {
     9: 48 * 60 * 60,  # 9次连续失败 -> 48小时断路
 }
 
+# 透传上游响应时需要去掉的头：逐跳头，以及httpx解码响应体后不再准确的编码和长度头
+HOP_BY_HOP_RESPONSE_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive",
+                               "proxy-connection", "proxy-authenticate", "te", "trailer", "upgrade"}
+
+# 转发请求时不透传的请求头，Authorization和Content-Length会根据配置和请求体重新设置
+# Accept-Encoding也会重新设置：客户端可能声明br/zstd等httpx无法解码的编码，
+# 而透传非流式响应时会去掉Content-Encoding，这种响应体会被原样当作未压缩内容返回
+# 逐跳头（RFC 7230 6.1，以及非标准的Proxy-Connection）同样不转发，HTTP/2上游会拒绝带有这些头的请求
+DROPPED_REQUEST_HEADERS = {b"host", b"authorization", b"content-length", b"accept-encoding",
+                           b"connection", b"keep-alive", b"proxy-connection", b"proxy-authenticate",
+                           b"proxy-authorization", b"te", b"trailer", b"transfer-encoding", b"upgrade"}
+
+# 非流式请求只声明httpx内置支持解码的编码；流式请求要求上游不压缩，以便直接按原始字节解析SSE
+FORWARD_ACCEPT_ENCODING = b"gzip, deflate"
+STREAM_ACCEPT_ENCODING = b"identity"
+
+# 请求体中的model字段，冒号前后允许空白，分组1为JSON字符串形式的值
+MODEL_FIELD_PATTERN = re.compile(rb'"model"\s*:\s*("(?:[^"\\]|\\.)*")')
+
 # 添加CORS中间件
 app.add_middleware(
     CORSMiddleware,
@@ -153,9 +185,9 @@ async def verify_admin_api_key(credentials: HTTPAuthorizationCredentials = Secur
     return api_key
 
 
-# 初始化Redis客户端
+# 初始化Redis配置，客户端及其连接池在应用启动时创建
 redis_url = os.getenv("REDIS_URL")
-if redis_client := redis.from_url(redis_url) if redis_url else None:
+if redis_url:
     logger.info("Redis连接已配置")
 else:
     logger.warning("Redis未配置，使用内存存储")
@@ -165,6 +197,287 @@ else:
         "model_mappings": {}  # 新增模型映射存储
     }
 
+# 正在关闭的旧客户端任务，保持强引用，避免任务在完成前被回收
+_closing_client_tasks = set()
+
+
+async def close_replaced_client(name, close):
+    """
+    关闭因事件循环变化而被替换的旧客户端，旧事件循环可能已关闭，尽力而为，失败时只记录日志
+    :param name: app.state中的属性名
+    :param close: 关闭旧客户端的协程
+    """
+    try:
+        await close
+    except Exception as e:
+        logger.warning(f"关闭旧的{name}客户端时出错: {str(e)}")
+
+
+def get_loop_bound_client(name, factory, close):
+    """
+    获取app.state中绑定到当前事件循环的共享客户端，不存在或属于其他事件循环时重新创建。
+    异步客户端的连接与创建时的事件循环绑定，部分Serverless环境不触发startup事件，且每次调用可能使用新的事件循环。
+    客户端保存在app.state.<name>，所属的事件循环保存在app.state.<name>_loop
+    :param name: app.state中的属性名
+    :param factory: 创建客户端的函数
+    :param close: 关闭客户端的函数，返回协程，用于关闭被替换的旧客户端
+    :return: 当前事件循环可用的客户端
+    """
+    loop = asyncio.get_running_loop()
+    client = getattr(app.state, name, None)
+    if client is None or getattr(app.state, f"{name}_loop", None) is not loop:
+        if client is not None:
+            logger.info(f"事件循环已变化，重新创建{name}客户端并关闭旧客户端")
+            task = loop.create_task(close_replaced_client(name, close(client)))
+            _closing_client_tasks.add(task)
+            task.add_done_callback(_closing_client_tasks.discard)
+        client = factory()
+        setattr(app.state, name, client)
+        setattr(app.state, f"{name}_loop", loop)
+    return client
+
+
+def create_redis_client():
+    """创建异步Redis客户端，使用固定大小的共享连接池，避免在async处理函数中阻塞事件循环"""
+    pool = ConnectionPool.from_url(redis_url, max_connections=50, decode_responses=False)
+    return AsyncRedis(connection_pool=pool)
+
+
+def get_redis_client():
+    """获取当前事件循环共享的Redis客户端，未配置Redis时返回None，未触发startup事件时（如部分Serverless环境）按需创建"""
+    if not redis_url:
+        return None
+    return get_loop_bound_client("redis", create_redis_client,
+                                 lambda client: client.close(close_connection_pool=True))
+
+
+@app.on_event("startup")
+async def init_redis_client():
+    get_redis_client()
+
+
+@app.on_event("shutdown")
+async def close_redis_client():
+    client = getattr(app.state, "redis", None)
+    if client is not None and getattr(app.state, "redis_loop", None) is asyncio.get_running_loop():
+        await client.close(close_connection_pool=True)
+
+
+# Redis中的存储键：API配置按ID存储在哈希中，模型映射整体存储，两者各有一个写入时递增的版本号
+API_CONFIGS_KEY = "api_configs:by_id"
+API_CONFIGS_VERSION_KEY = "api_configs:v"
+MODEL_MAPPINGS_KEY = "model_mappings"
+MODEL_MAPPINGS_VERSION_KEY = "model_mappings:v"
+# 旧版本将所有配置整体存储在一个键中，读取时会合并到哈希中
+LEGACY_API_CONFIGS_KEY = "api_configs"
+
+# 进程内缓存反序列化后的配置和模型映射，通过Redis中的版本号判断是否失效，
+# 写操作会递增版本号，多个进程/实例之间也能感知到变更
+_configs_cache = {"v": None, "data": None}
+# 版本号键不存在（从未写入，或由旧版本写入的数据）时使用的版本号，与缓存未加载时的None区分，
+# INCR产生的版本号从1开始，不会与之冲突
+ABSENT_VERSION = b"0"
+_mappings_cache = {"v": None, "data": None}
+
+
+def decode_stored_blob(raw, decoder):
+    """
+    解码Redis中msgpack存储的数据，兼容旧版本以JSON格式写入的数据
+    :param raw: Redis中的原始数据
+    :param decoder: 带结构校验的msgpack解码器
+    :return: 由dict/list组成的数据
+    """
+    # msgpack编码的列表/字典首字节不会是 [ 或 {，以此区分旧版本的JSON数据
+    if raw[:1] in (b"[", b"{"):
+        return orjson.loads(raw)
+    return msgspec.to_builtins(decoder.decode(raw))
+
+
+def decode_stored_configs(entries):
+    """
+    解码哈希中按ID存储的API配置
+    :param entries: HGETALL的结果 {id: msgpack编码的配置}
+    :return: 按ID（即创建时间）排序的配置列表
+    """
+    return [msgspec.to_builtins(API_CONFIG_DECODER.decode(entries[config_id])) for config_id in sorted(entries)]
+
+
+async def merge_legacy_api_configs(raw):
+    """
+    将旧版本整体存储的配置列表合并到按ID存储的哈希中，哈希中已有的同ID配置保持不变。
+    旧版本的ID精确到秒，列表中可能存在同ID的多个配置，后出现的配置会分配新的ID，避免迁移时丢失
+    :param raw: 旧版本存储的配置列表原始数据
+    """
+    configs = decode_stored_blob(raw, API_CONFIGS_DECODER)
+
+    # 新ID按列表顺序确定生成，多个实例同时迁移时写入的内容一致，HSETNX仍然幂等
+    seen_ids = set()
+    for config in configs:
+        config_id = config["id"]
+        suffix = 1
+        while config["id"] in seen_ids:
+            config["id"] = f"{config_id}-{suffix}"
+            suffix += 1
+        if config["id"] != config_id:
+            logger.warning(f"旧格式的配置中存在重复的ID {config_id}，迁移时已将其中一个配置的ID改为 {config['id']}")
+        seen_ids.add(config["id"])
+
+    async with get_redis_client().pipeline() as pipe:
+        for config in configs:
+            pipe.hsetnx(API_CONFIGS_KEY, config["id"], msgspec.msgpack.encode(config))
+        pipe.delete(LEGACY_API_CONFIGS_KEY)
+        pipe.incr(API_CONFIGS_VERSION_KEY)
+        await pipe.execute()
+    logger.info(f"已将 {len(configs)} 个旧格式的配置迁移到 {API_CONFIGS_KEY}")
+
+
+async def batch_load_state():
+    """
+    同时获取所有API配置和模型映射，版本号未变化的直接复用进程内缓存。
+    Redis模式下两个版本号通过一次pipeline读取，过期的数据再通过一次pipeline拉取
+    :return: (api_configs, model_mappings)，调用方不应直接修改返回的数据
+    """
+    redis_client = get_redis_client()
+    if not redis_client:
+        return in_memory_db["api_configs"], in_memory_db.get("model_mappings", {})
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.get(API_CONFIGS_VERSION_KEY)
+        pipe.get(MODEL_MAPPINGS_VERSION_KEY)
+        configs_version, mappings_version = await pipe.execute()
+
+    # 版本号键不存在时同样可以缓存，写操作会创建版本号键，届时版本号变化自然会重新加载
+    configs_version = configs_version or ABSENT_VERSION
+    mappings_version = mappings_version or ABSENT_VERSION
+    configs_stale = configs_version != _configs_cache["v"]
+    mappings_stale = mappings_version != _mappings_cache["v"]
+    if configs_stale or mappings_stale:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            if configs_stale:
+                pipe.hgetall(API_CONFIGS_KEY)
+                pipe.get(LEGACY_API_CONFIGS_KEY)
+            if mappings_stale:
+                pipe.get(MODEL_MAPPINGS_KEY)
+            results = await pipe.execute()
+
+        if configs_stale:
+            entries, legacy_raw = results[0], results[1]
+            if legacy_raw:
+                await merge_legacy_api_configs(legacy_raw)
+                entries = await redis_client.hgetall(API_CONFIGS_KEY)
+            configs = decode_stored_configs(entries)
+            _configs_cache["v"] = configs_version
+            # 内容未变化时保留原对象，模型路由索引按对象判断是否需要重建
+            if configs != _configs_cache["data"]:
+                _configs_cache["data"] = configs
+        if mappings_stale:
+            raw = results[-1]
+            mappings = decode_stored_blob(raw, MODEL_MAPPINGS_DECODER) if raw else {}
+            _mappings_cache["v"] = mappings_version
+            if mappings != _mappings_cache["data"]:
+                _mappings_cache["data"] = mappings
+
+    return _configs_cache["data"], _mappings_cache["data"]
+
+
+async def load_api_configs():
+    """获取所有API配置，调用方不应直接修改返回的列表"""
+    configs, _ = await batch_load_state()
+    return configs
+
+
+async def load_model_mappings():
+    """获取所有模型映射，调用方不应直接修改返回的字典"""
+    _, mappings = await batch_load_state()
+    return mappings
+
+
+async def add_api_config(config):
+    """
+    新增API配置，Redis模式下只写入这一条配置
+    :param config: 要新增的配置
+    :return: 是否新增成功，ID已存在时返回False
+    """
+    if redis_client := get_redis_client():
+        # 写入与递增版本号放在同一个事务中，保证版本号与数据一一对应
+        async with redis_client.pipeline() as pipe:
+            pipe.hsetnx(API_CONFIGS_KEY, config["id"], msgspec.msgpack.encode(config))
+            pipe.incr(API_CONFIGS_VERSION_KEY)
+            added, _ = await pipe.execute()
+        return bool(added)
+
+    if any(c["id"] == config["id"] for c in in_memory_db["api_configs"]):
+        return False
+    in_memory_db["api_configs"] = in_memory_db["api_configs"] + [config]
+    return True
+
+
+async def update_api_config(config):
+    """
+    覆盖已有的API配置，Redis模式下只写入这一条配置
+    :param config: 更新后的配置
+    """
+    if redis_client := get_redis_client():
+        async with redis_client.pipeline() as pipe:
+            pipe.hset(API_CONFIGS_KEY, config["id"], msgspec.msgpack.encode(config))
+            pipe.incr(API_CONFIGS_VERSION_KEY)
+            await pipe.execute()
+    else:
+        in_memory_db["api_configs"] = [config if c["id"] == config["id"] else c for c in in_memory_db["api_configs"]]
+
+
+async def delete_api_config(config_id):
+    """
+    删除API配置，Redis模式下只删除这一条配置
+    :param config_id: 配置ID
+    """
+    if redis_client := get_redis_client():
+        async with redis_client.pipeline() as pipe:
+            pipe.hdel(API_CONFIGS_KEY, config_id)
+            pipe.incr(API_CONFIGS_VERSION_KEY)
+            await pipe.execute()
+    else:
+        in_memory_db["api_configs"] = [c for c in in_memory_db["api_configs"] if c["id"] != config_id]
+
+
+async def save_model_mappings(mappings):
+    """保存所有模型映射"""
+    if redis_client := get_redis_client():
+        async with redis_client.pipeline() as pipe:
+            pipe.set(MODEL_MAPPINGS_KEY, msgspec.msgpack.encode(mappings))
+            pipe.incr(MODEL_MAPPINGS_VERSION_KEY)
+            _, version = await pipe.execute()
+        _mappings_cache["v"], _mappings_cache["data"] = str(version).encode(), mappings
+    else:
+        in_memory_db["model_mappings"] = mappings
+
+
+def create_http_client():
+    """创建转发上游请求使用的HTTP客户端，连接池在所有请求间共享，避免重复建立TCP/TLS连接"""
+    return httpx.AsyncClient(
+        follow_redirects=True,
+        timeout=TIMEOUT_SECONDS,
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100, keepalive_expiry=30),
+        http2=True,
+    )
+
+
+def get_http_client():
+    """获取当前事件循环共享的HTTP客户端，未触发startup事件时（如部分Serverless环境）按需创建"""
+    return get_loop_bound_client("http", create_http_client, lambda client: client.aclose())
+
+
+@app.on_event("startup")
+async def init_http_client():
+    get_http_client()
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    client = getattr(app.state, "http", None)
+    if client is not None and getattr(app.state, "http_loop", None) is asyncio.get_running_loop():
+        await client.aclose()
+
 
 # 模型映射数据模型
 class ModelMapping(BaseModel):
@@ -192,7 +505,7 @@ class ModelMappingRequest(BaseModel):
 # API配置相关端点
 @app.post("/logout")
 async def logout():
-    response = JSONResponse({"status": "success"})
+    response = ORJSONResponse({"status": "success"})
     response.delete_cookie(key="auth_key")
     response.delete_cookie(key="remember_auth")
     return response
@@ -209,25 +522,38 @@ async def get_admin_api_key_from_cookie(request: Request):
     return auth_key
 
 
+def encode_auth_header(api_key):
+    """
+    将上游API密钥编码为转发时使用的Authorization头
+    :param api_key: 上游API密钥
+    :return: 字节串形式的Authorization头，密钥包含无法作为请求头发送的字符时抛出UnicodeEncodeError
+    """
+    return b"Bearer " + api_key.encode("latin-1")
+
+
+def validate_api_key(api_key):
+    """写入配置前校验API密钥能否作为请求头发送，避免无效密钥在转发时才出错"""
+    try:
+        encode_auth_header(api_key)
+    except UnicodeEncodeError:
+        raise HTTPException(status_code=400, detail="API密钥包含无法作为请求头发送的字符，请检查是否误粘贴了全角或特殊字符")
+
+
 @app.post("/api/configs")
 async def create_config(config: APIConfig, api_key: str = Depends(get_admin_api_key_from_cookie)):
     """创建新的API配置"""
+    validate_api_key(config.api_key)
     config_dict = config.model_dump()
     config_dict["id"] = datetime.now().strftime("%Y%m%d%H%M%S")
     config_dict["created_at"] = datetime.now().isoformat()
 
     # 如果未指定厂商标识符，使用base_url的域名作为厂商标识符
     if not config_dict.get("vendor"):
-        from urllib.parse import urlparse
         parsed_url = urlparse(config_dict["base_url"])
         config_dict["vendor"] = parsed_url.netloc
 
-    if redis_client:
-        configs = json.loads(redis_client.get("api_configs") or "[]")
-        configs.append(config_dict)
-        redis_client.set("api_configs", json.dumps(configs))
-    else:
-        in_memory_db["api_configs"].append(config_dict)
+    if not await add_api_config(config_dict):
+        raise HTTPException(status_code=409, detail=f"ID为{config_dict['id']}的配置已存在，请稍后重试")
 
     return {"message": "配置已创建", "config_id": config_dict["id"]}
 
@@ -235,14 +561,12 @@ async def create_config(config: APIConfig, api_key: str = Depends(get_admin_api_
 @app.put("/api/configs/{config_id}")
 async def update_config(config_id: str, config: APIConfig, api_key: str = Depends(get_admin_api_key_from_cookie)):
     """更新现有的API配置"""
-    if redis_client:
-        configs = json.loads(redis_client.get("api_configs") or "[]")
-    else:
-        configs = in_memory_db["api_configs"]
+    validate_api_key(config.api_key)
+    configs = await load_api_configs()
 
     # 查找要更新的配置
     found = False
-    for i, existing_config in enumerate(configs):
+    for existing_config in configs:
         if existing_config["id"] == config_id:
             # 保留原有的id和created_at
             config_dict = config.model_dump()
@@ -253,11 +577,9 @@ async def update_config(config_id: str, config: APIConfig, api_key: str = Depend
             if not config_dict.get("vendor"):
                 config_dict["vendor"] = existing_config.get("vendor")
                 if not config_dict["vendor"]:
-                    from urllib.parse import urlparse
                     parsed_url = urlparse(config_dict["base_url"])
                     config_dict["vendor"] = parsed_url.netloc
 
-            configs[i] = config_dict
             found = True
             break
 
@@ -265,48 +587,36 @@ async def update_config(config_id: str, config: APIConfig, api_key: str = Depend
         raise HTTPException(status_code=404, detail=f"未找到ID为{config_id}的配置")
 
     # 保存更新后的配置
-    if redis_client:
-        redis_client.set("api_configs", json.dumps(configs))
-    else:
-        in_memory_db["api_configs"] = configs
+    await update_api_config(config_dict)
 
     return {"message": "配置已更新", "config_id": config_id}
 
 
+def mask_config_api_key(config):
+    """返回隐藏了API密钥的配置浅拷贝，仅用于展示，不修改原始数据"""
+    api_key = config["api_key"]
+    return {**config, "api_key": "**" + api_key[-4:] if len(api_key) > 4 else "****"}
+
+
 @app.get("/api/configs")
 async def list_configs(api_key: str = Depends(get_admin_api_key_from_cookie)):
     """列出所有API配置"""
-    if redis_client:
-        configs = json.loads(redis_client.get("api_configs") or "[]")
-    else:
-        configs = in_memory_db["api_configs"]
-
-    # 创建配置的深拷贝，避免修改原始数据
-    configs_for_display = copy.deepcopy(configs)
+    configs = await load_api_configs()
 
     # 隐藏API密钥（仅在显示时）
-    for config in configs_for_display:
-        config["api_key"] = "**" + config["api_key"][-4:] if len(config["api_key"]) > 4 else "****"
-
-    return {"configs": configs_for_display}
+    return {"configs": [mask_config_api_key(config) for config in configs]}
 
 
 @app.get("/api/configs/{config_id}")
 async def get_config(config_id: str, api_key: str = Depends(get_admin_api_key_from_cookie)):
     """获取单个API配置的详细信息"""
-    if redis_client:
-        configs = json.loads(redis_client.get("api_configs") or "[]")
-    else:
-        configs = in_memory_db["api_configs"]
+    configs = await load_api_configs()
 
     # 查找指定的配置
     for config in configs:
         if config["id"] == config_id:
-            # 创建配置的深拷贝，避免修改原始数据
-            config_copy = copy.deepcopy(config)
             # 隐藏API密钥（仅在显示时）
-            config_copy["api_key"] = "**" + config_copy["api_key"][-4:] if len(config_copy["api_key"]) > 4 else "****"
-            return config_copy
+            return mask_config_api_key(config)
 
     raise HTTPException(status_code=404, detail=f"未找到ID为{config_id}的配置")
 
@@ -314,12 +624,9 @@ async def get_config(config_id: str, api_key: str = Depends(get_admin_api_key_fr
 @app.delete("/api/configs/{config_id}")
 async def delete_config(config_id: str, api_key: str = Depends(get_admin_api_key_from_cookie)):
     """删除指定的API配置"""
-    if redis_client:
-        configs = json.loads(redis_client.get("api_configs") or "[]")
-        configs = [c for c in configs if c["id"] != config_id]
-        redis_client.set("api_configs", json.dumps(configs))
-    else:
-        in_memory_db["api_configs"] = [c for c in in_memory_db["api_configs"] if c["id"] != config_id]
+    # 先加载一次配置，确保旧格式的配置已迁移，避免删除后又被合并回来
+    await load_api_configs()
+    await delete_api_config(config_id)
 
     return {"message": "配置已删除"}
 
@@ -328,14 +635,9 @@ async def delete_config(config_id: str, api_key: str = Depends(get_admin_api_key
 @app.post("/api/model-mappings")
 async def create_model_mapping(mapping: ModelMappingRequest, api_key: str = Depends(get_admin_api_key_from_cookie)):
     """创建或更新模型映射"""
-    if redis_client:
-        mappings = json.loads(redis_client.get("model_mappings") or "{}")
-        mappings[mapping.unified_name] = mapping.vendor_models
-        redis_client.set("model_mappings", json.dumps(mappings))
-    else:
-        if "model_mappings" not in in_memory_db:
-            in_memory_db["model_mappings"] = {}
-        in_memory_db["model_mappings"][mapping.unified_name] = mapping.vendor_models
+    mappings = dict(await load_model_mappings())
+    mappings[mapping.unified_name] = mapping.vendor_models
+    await save_model_mappings(mappings)
 
     return {"message": f"模型映射已创建: {mapping.unified_name}"}
 
@@ -343,10 +645,7 @@ async def create_model_mapping(mapping: ModelMappingRequest, api_key: str = Depe
 @app.get("/api/model-mappings")
 async def list_model_mappings(api_key: str = Depends(get_admin_api_key_from_cookie)):
     """列出所有模型映射"""
-    if redis_client:
-        mappings = json.loads(redis_client.get("model_mappings") or "{}")
-    else:
-        mappings = in_memory_db.get("model_mappings", {})
+    mappings = await load_model_mappings()
 
     return {"mappings": mappings}
 
@@ -354,51 +653,105 @@ async def list_model_mappings(api_key: str = Depends(get_admin_api_key_from_cook
 @app.delete("/api/model-mappings/{unified_name}")
 async def delete_model_mapping(unified_name: str, api_key: str = Depends(get_admin_api_key_from_cookie)):
     """删除指定的模型映射"""
-    if redis_client:
-        mappings = json.loads(redis_client.get("model_mappings") or "{}")
-        if unified_name in mappings:
-            del mappings[unified_name]
-            redis_client.set("model_mappings", json.dumps(mappings))
-    else:
-        if "model_mappings" in in_memory_db and unified_name in in_memory_db["model_mappings"]:
-            del in_memory_db["model_mappings"][unified_name]
+    mappings = await load_model_mappings()
+    if unified_name in mappings:
+        mappings = {k: v for k, v in mappings.items() if k != unified_name}
+        await save_model_mappings(mappings)
 
     return {"message": f"模型映射已删除: {unified_name}"}
 
 
-def get_config_model_pairs(model: str):
+# 模型路由索引 {请求的模型名称: ((config, actual_model), ...)}，以及构建索引时使用的配置和模型映射。
+# 配置和模型映射只有在内容变化时才会替换为新的对象（版本号键不存在时同样保留缓存），据此判断索引是否需要重建
+_router_index = {"source": (None, None), "index": {}}
+
+
+def build_forward_url(base_url):
+    """
+    根据配置的base_url计算转发chat/completions请求的完整地址
+    :param base_url: 配置的base_url
+    :return: 转发地址
+    """
+    if base_url.endswith("#"):
+        # 如果以#结尾，移除#后直接使用
+        return base_url[:-1]
+    if base_url.endswith("/"):
+        # 如果以/结尾，直接拼接chat/completions
+        return f"{base_url}chat/completions"
+    # 默认拼接完整路径
+    return f"{base_url}/v1/chat/completions"
+
+
+def rebuild_index(configs, mappings):
+    """
+    根据配置和模型映射构建模型路由索引，路由时只需一次字典查询，无需遍历所有配置
+    每个配置按以下顺序匹配，且实际模型必须在配置支持的模型列表中：
+    1. 配置内的模型映射 {统一模型名称: 实际模型名称}
+    2. 全局模型映射中该配置厂商对应的实际模型
+    3. 配置原生支持的模型
+    索引中的配置会附带预先计算好的转发地址（_forward_url）和认证头（_auth_header）
+    :param configs: 所有API配置
+    :param mappings: 全局模型映射 {统一模型名称: {厂商标识符: 实际模型名称}}
+    :return: 模型路由索引
+    """
+    index = {}
+    for config in configs:
+        # 预先计算认证头，已存储的无效密钥只跳过该配置，不影响其他配置的路由
+        try:
+            auth_header = encode_auth_header(config["api_key"])
+        except UnicodeEncodeError:
+            logger.error(f"配置 {config.get('id', UNKNOWN)} 的API密钥包含无法作为请求头发送的字符，已跳过该配置")
+            continue
+
+        # 预先计算转发时只与配置有关的字段，复制一份，避免写入存储
+        config = {
+            **config,
+            "_forward_url": build_forward_url(config["base_url"]),
+            "_auth_header": auth_header,
+        }
+        supported_models = set(config["models"])
+        vendor = config.get("vendor")
+
+        routes = list((config.get("model_mappings") or {}).items())
+        routes.extend((unified_name, vendor_models[vendor])
+                      for unified_name, vendor_models in mappings.items() if vendor in vendor_models)
+        routes.extend((model, model) for model in config["models"])
+
+        seen = set()
+        for model, actual_model in routes:
+            if actual_model not in supported_models or (model, actual_model) in seen:
+                continue
+            seen.add((model, actual_model))
+            index.setdefault(model, []).append((config, actual_model))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"模型路由: {model} -> {actual_model} (配置ID: {config.get('id', UNKNOWN)})")
+
+    # 索引建好后不再修改，使用元组存储候选列表
+    index = {model: tuple(pairs) for model, pairs in index.items()}
+    _router_index["source"] = (configs, mappings)
+    _router_index["index"] = index
+    return index
+
+
+async def get_config_model_pairs(model: str):
     """
     查找有当前模型的配置，找不到的话，抛异常
     :param model:
     :return: 返回所有符合条件的配置和模型对
     """
-    logger.info(f"查找模型配置: {model}")
-
-    if redis_client:
-        configs = json.loads(redis_client.get("api_configs") or "[]")
-    else:
-        configs = in_memory_db["api_configs"]
-        mappings = in_memory_db.get("model_mappings", {})
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"查找模型配置: {model}")
 
-    logger.info(f"加载了 {len(configs)} 个配置")
+    configs, mappings = await batch_load_state()
 
-    matching_configs = []
-
-    # 遍历所有配置
-    for config in configs:
-        # 检查配置中的模型映射
-        if config.get("model_mappings") and model in config["model_mappings"]:
-            actual_model = config["model_mappings"][model]
-            # 确保配置支持实际模型
-            if actual_model in config["models"]:
-                matching_configs.append((config, actual_model))
-                logger.info(f"找到配置内映射: {model} -> {actual_model} (配置ID: {config.get('id', UNKNOWN)})")
-        
-        # 检查是否原生支持该模型
-        if model in config["models"]:
-            matching_configs.append((config, model))
-            logger.info(f"找到原生支持: {model} (配置ID: {config.get('id', UNKNOWN)})")
+    source_configs, source_mappings = _router_index["source"]
+    if configs is source_configs and mappings is source_mappings:
+        index = _router_index["index"]
+    else:
+        logger.info(f"配置已变更，重建模型路由索引，共 {len(configs)} 个配置")
+        index = rebuild_index(configs, mappings)
 
+    matching_configs = index.get(model)
     if not matching_configs:
         logger.warning(f"没有找到支持模型 {model} 的配置")
         raise HTTPException(status_code=404, detail=f"没有找到支持模型 {model} 的配置")
@@ -406,7 +759,6 @@ def get_config_model_pairs(model: str):
     return matching_configs
 
 
-
 # 获取所有可用模型列表的端点
 @app.api_route("/v1/models", methods=["GET", "POST"])
 async def list_available_models(request: Request):
@@ -533,10 +885,10 @@ async def record_model_request(model_key, request_record, history_records):
 
         # 尝试使用Redis保存（如果有配置）
         try:
-            if redis_client:
+            if redis_client := get_redis_client():
                 # 将记录转换为JSON并保存到Redis
-                serialized_records = json.dumps([record.dict() for record in filtered_records])
-                redis_client.set(model_key, serialized_records, ex=int(max_age / 1000))
+                serialized_records = orjson.dumps([record.model_dump() for record in filtered_records])
+                await redis_client.set(model_key, serialized_records, ex=int(max_age / 1000))
                 logger.debug(f"模型请求记录已保存到Redis: {model_key}")
             else:
                 # 如果没有Redis，则保存到内存中
@@ -554,117 +906,103 @@ async def record_model_request(model_key, request_record, history_records):
         return history_records
 
 
-@app.api_route("/v1/chat/completions", methods=["GET", "POST", "PUT", "DELETE"])
-async def openai_proxy(request: Request):
-    """OpenAI API兼容代理 - 仅支持chat/completions端点"""
-    # 验证API密钥（从请求头中获取）
-    auth_header = request.headers.get("Authorization")
-    if not auth_header:
-        raise HTTPException(
-            status_code=401,
-            detail="缺少认证信息。请使用'Authorization: Bearer YOUR_API_KEY'格式提供访问密钥"
-        )
+def parse_request_meta(body):
+    """
+    解析请求体中路由需要的字段，完整的解析结果用完即丢弃，不在转发期间常驻内存
+    :param body: 原始请求体
+    :return: (model, is_stream)
+    """
+    if not body:
+        return "", False
+    body_dict = orjson.loads(body)
+    return body_dict.get("model", ""), body_dict.get("stream", False)
 
-    try:
-        # 提取API密钥
-        scheme, credentials = auth_header.split()
-        if scheme.lower() != "bearer":
-            raise HTTPException(
-                status_code=401,
-                detail="认证格式错误。请使用'Authorization: Bearer YOUR_API_KEY'格式"
-            )
-        api_key = credentials
 
-        # 检查API密钥有效性
-        if not ALLOWED_API_KEYS and not ADMIN_API_KEY:
-            raise HTTPException(
-                status_code=401,
-                detail="未配置允许的API密钥。请在环境变量中设置TEMP_API_KEY或ADMIN_API_KEY"
-            )
+def replace_request_model(body, model, actual_model):
+    """
+    替换请求体中的模型名称。请求体中只有一个model键时直接在字节层面替换其值，避免重新序列化整个请求体，
+    否则（如存在嵌套的model字段）回退为完整解析后重新序列化
+    :param body: 原始请求体
+    :param model: 请求中的模型名称
+    :param actual_model: 实际使用的模型名称
+    :return: 替换后的请求体
+    """
+    if body.count(b'"model"') == 1:
+        match = MODEL_FIELD_PATTERN.search(body)
+        if match and orjson.loads(match.group(1)) == model:
+            return body[:match.start(1)] + orjson.dumps(actual_model) + body[match.end(1):]
 
-        # 验证API密钥
-        if api_key != ADMIN_API_KEY and api_key not in ALLOWED_API_KEYS:
-            raise HTTPException(
-                status_code=401,
-                detail="无效的API密钥"
-            )
-    except ValueError:
-        raise HTTPException(
-            status_code=401,
-            detail="认证格式错误。请使用'Authorization: Bearer YOUR_API_KEY'格式"
-        )
+    body_dict = orjson.loads(body)
+    body_dict["model"] = actual_model
+    return orjson.dumps(body_dict)
 
-    # 获取请求内容
+
+async def prepare_forward(request: Request):
+    """
+    准备转发请求：校验API密钥，读取请求体，选择配置并替换模型名称，构建转发的请求头
+    :param request: 客户端请求
+    :return: (url, headers, body, is_stream, model_request_key, current_request_history)
+    """
+    # 验证API密钥（从请求头中获取）
+    await get_api_key_from_request(request)
+
+    # 获取请求内容，只取出路由需要的字段
     body = await request.body()
-    body_dict = json.loads(body) if body else {}
+    model, is_stream = parse_request_meta(body)
 
     # 获取模型名称
-    model = body_dict.get("model", "")
     if not model:
         raise HTTPException(status_code=400, detail="请求中未指定模型")
 
-    logger.info(f"收到API请求: 路径=/v1/chat/completions, 模型={model}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"收到API请求: 路径={request.url.path}, 模型={model}")
 
-    try:
-        # 首先过滤出包含了当前模型的配置列表
-        config_model_pairs = get_config_model_pairs(model)
-        config_model_key_list = []
-        for config, actual_model in config_model_pairs:
-            config_model_key_list.append(build_model_request_record_key(config.get("id", UNKNOWN), actual_model))
-
-        # 查询这些模型的请求历史
-        model_request_map = batch_get_model_request_record(config_model_key_list)
-
-        config, actual_model = weighted_choice(config_model_pairs, model_request_map)
-
-        logger.info(f"选择配置: ID={config.get('id', 'unknown')}, 实际模型={actual_model}")
-
-        # 如果实际模型名称与请求的不同，替换请求中的模型名称
-        if actual_model != model:
-            logger.info(f"模型映射: {model} -> {actual_model}")
-            body_dict["model"] = actual_model
-            body = json.dumps(body_dict).encode()
-
-        model_request_key = build_model_request_record_key(config.get("id", UNKNOWN), actual_model)
-        current_request_history = model_request_map.get(model_request_key)
-
-        # 准备转发
-        headers = dict(request.headers)
-        headers.pop("host", None)
-
-        # 移除所有形式的authorization头（不区分大小写）
-        auth_headers = [k for k in headers.keys() if k.lower() == "authorization"]
-        for key in auth_headers:
-            headers.pop(key)
-
-        # 更新Content-Length头以匹配新的请求体长度
-        content_length_headers = [k for k in headers.keys() if k.lower() == "content-length"]
-        for key in content_length_headers:
-            headers.pop(key)
-
-        # 添加新的Content-Length头
-        if body:
-            headers["Content-Length"] = str(len(body))
-
-        # 添加正确的Authorization头
-        headers["Authorization"] = f"Bearer {config['api_key']}"
-
-        # 设置正确的base_url和请求URL
-        base_url = config["base_url"]
-        if base_url.endswith("#"):
-            # 如果以#结尾，移除#后直接使用
-            url = base_url[:-1]
-        elif base_url.endswith("/"):
-            # 如果以/结尾，直接拼接chat/completions
-            url = f"{base_url}chat/completions"
-        else:
-            # 默认拼接完整路径
-            url = f"{base_url}/v1/chat/completions"
+    # 首先过滤出包含了当前模型的配置列表
+    config_model_pairs = await get_config_model_pairs(model)
+    config_model_key_list = []
+    for config, actual_model in config_model_pairs:
+        config_model_key_list.append(build_model_request_record_key(config.get("id", UNKNOWN), actual_model))
 
-        logger.info(f"转发请求到: {url}")
+    # 查询这些模型的请求历史
+    model_request_map = await batch_get_model_request_record(config_model_key_list)
 
-        # 判断是否为流式请求
-        is_stream = body_dict.get("stream", False)
+    config, actual_model = weighted_choice(config_model_pairs, model_request_map)
+
+    logger.info(f"选择配置: ID={config.get('id', 'unknown')}, 实际模型={actual_model}")
+
+    # 如果实际模型名称与请求的不同，替换请求中的模型名称
+    if actual_model != model:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"模型映射: {model} -> {actual_model}")
+        body = replace_request_model(body, model, actual_model)
+
+    model_request_key = build_model_request_record_key(config.get("id", UNKNOWN), actual_model)
+    current_request_history = model_request_map.get(model_request_key)
+
+    # 准备转发，一次遍历原始请求头（ASGI中已是小写字节串），去掉需要重新设置或不应转发的头，
+    # 直接以字节串转发，httpx同样接受，无需逐个解码
+    headers = {k: v for k, v in request.headers.raw if k not in DROPPED_REQUEST_HEADERS}
+    headers[b"accept-encoding"] = STREAM_ACCEPT_ENCODING if is_stream else FORWARD_ACCEPT_ENCODING
+
+    # 添加新的Content-Length头，以匹配新的请求体长度
+    if body:
+        headers[b"content-length"] = str(len(body)).encode()
+
+    # 添加正确的Authorization头，请求地址和认证头在构建路由索引时已预先计算
+    headers[b"authorization"] = config["_auth_header"]
+    url = config["_forward_url"]
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"转发请求到: {url}")
+
+    return url, headers, body, is_stream, model_request_key, current_request_history
+
+
+@app.api_route("/v1/chat/completions", methods=["GET", "POST", "PUT", "DELETE"])
+async def openai_proxy(request: Request):
+    """OpenAI API兼容代理 - 仅支持chat/completions端点"""
+    try:
+        url, headers, body, is_stream, model_request_key, current_request_history = await prepare_forward(request)
 
         if is_stream:
             from api.stream_handler import StreamHandler
@@ -680,25 +1018,28 @@ async def openai_proxy(request: Request):
             return handler.get_response()
         else:
             # 非流式请求的处理
-            async with httpx.AsyncClient(follow_redirects=True, timeout=TIMEOUT_SECONDS) as client:
-                response = await client.request(
-                    request.method,
-                    url,
-                    headers=headers,
-                    content=body
-                )
+            response = await get_http_client().request(
+                request.method,
+                url,
+                headers=headers,
+                content=body
+            )
 
-                # 直接返回响应内容
-                return JSONResponse(
-                    content=response.json(),
-                    status_code=response.status_code,
-                    headers=dict(response.headers)
-                )
+            # 直接透传响应内容，无需解析后再序列化
+            return Response(
+                content=response.content,
+                status_code=response.status_code,
+                headers={k: v for k, v in response.headers.items() if k not in HOP_BY_HOP_RESPONSE_HEADERS},
+                media_type=response.headers.get("content-type", "application/json")
+            )
+    except HTTPException as e:
+        # 认证失败、未指定模型、没有可用配置等，直接返回对应的HTTP错误
+        raise e
     except Exception as e:
         # 添加详细的错误日志
         logger.error(f"处理请求时出错: {str(e)}")
         # 返回友好的错误信息
-        return JSONResponse(
+        return ORJSONResponse(
             content={"error": "处理请求时出错", "message": str(e)},
             status_code=500
         )
@@ -816,7 +1157,7 @@ def build_model_key(config_id, model_name):
     return hashlib.md5(key.encode()).hexdigest()
 
 
-def batch_get_model_request_record(model_key_list):
+async def batch_get_model_request_record(model_key_list):
     """
     批量获取模型的请求记录列表
     :param model_key_list:
@@ -828,14 +1169,11 @@ def batch_get_model_request_record(model_key_list):
 
         result = {}
 
-        if redis_client:
-            # 由于这是在同步函数中，我们不能直接使用await
+        if redis_client := get_redis_client():
             records_json_list = []
             try:
-                # 对于同步Redis客户端
-                records_json_list = redis_client.mget(final_key_list)
+                records_json_list = await redis_client.mget(final_key_list)
             except Exception as e:
-                # 如果Redis客户端是异步的，则需要在外部处理
                 logger.warning(f"从redis获取模型请求历史记录时出错: {str(e)}")
                 pass
 
@@ -846,8 +1184,9 @@ def batch_get_model_request_record(model_key_list):
                     records_json = records_json_list[i]
                     if not records_json:
                         continue
-                    records_data = json.loads(records_json)
-                    history_records = deque(ModelRequestRecord(**record) for record in records_data)
+                    records_data = orjson.loads(records_json)
+                    # 记录由本服务写入，可信，跳过pydantic校验直接构建
+                    history_records = deque(ModelRequestRecord.model_construct(**record) for record in records_data)
                     result[model_key] = history_records
 
         else:
@@ -928,7 +1267,7 @@ def weighted_choice(config_model_pairs, model_request_map):
     4. 归一化所有权重并进行加权随机选择
     
     Args:
-        config_model_pairs (List[Tuple[Dict, str]]): 配置和模型名称的元组列表 [(config, model_name), ...]
+        config_model_pairs (Sequence[Tuple[Dict, str]]): 配置和模型名称的元组序列 ((config, model_name), ...)
         model_request_map (Dict[str, List[ModelRequestRecord]): 模型的最近请求记录
     
     Returns:
@@ -971,7 +1310,8 @@ def weighted_choice(config_model_pairs, model_request_map):
                 # 引入非线性变换强化成功率影响（示例：平方）
                 success_factor = success_rate ** 2
                 weight = response_time_factor * success_factor
-                logger.debug(f"模型 {model_name} 动态权重: 成功率={success_rate:.2f} 响应={avg_first_token_time:.0f}ms 权重={weight:.4f}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"模型 {model_name} 动态权重: 成功率={success_rate:.2f} 响应={avg_first_token_time:.0f}ms 权重={weight:.4f}")
 
         weights.append(weight)
 
@@ -980,4 +1320,4 @@ def weighted_choice(config_model_pairs, model_request_map):
     normalized_weights = [w / total_weight for w in weights]
 
     # 根据权重进行随机选择
-    return random.choices(valid_config_model_pairs, weights=normalized_weights, k=1)[0]
+    return _choices(valid_config_model_pairs, weights=normalized_weights, k=1)[0]
@@ -1,3 +1,6 @@
+from typing import List, Dict, Optional
+
+import msgspec
 from pydantic import BaseModel, Field
 import time
 import threading
@@ -13,6 +16,23 @@ class ModelRequestRecord(BaseModel):
     request_type: str = Field(..., description="请求类型，如：chat, embedding等等")
 
 
+class StoredAPIConfig(msgspec.Struct):
+    """Redis中存储的API配置，使用msgpack编码，字段与APIConfig一致"""
+    id: str
+    api_key: str
+    base_url: str
+    models: List[str]
+    created_at: Optional[str] = None
+    vendor: Optional[str] = None
+    model_mappings: Optional[Dict[str, str]] = None
+
+
+# Redis中存储数据的解码器，解码的同时完成结构校验。API_CONFIGS_DECODER仅用于读取旧版本整体存储的配置列表
+API_CONFIG_DECODER = msgspec.msgpack.Decoder(StoredAPIConfig)
+API_CONFIGS_DECODER = msgspec.msgpack.Decoder(List[StoredAPIConfig])
+MODEL_MAPPINGS_DECODER = msgspec.msgpack.Decoder(Dict[str, Dict[str, str]])
+
+
 class TokenBucket:
     def __init__(self, rate, capacity):
         self.rate = float(rate)  # 漏出速率 (数据包/秒)
@@ -1,21 +1,37 @@
-import json
 import logging
 import time
 import uuid
 import asyncio
+import contextlib
 from datetime import datetime
 
-import httpx
+import orjson
 from fastapi.responses import StreamingResponse
 from api.models import ModelRequestRecord
 from api.models import TokenBucket
-from api.index import record_model_request
+from api.index import record_model_request, get_http_client
 
 CHUNK_SPLITTER = b"\n\n"
 
+# 正在写入的请求记录任务，保持强引用，避免任务在完成前被回收
+_pending_record_tasks = set()
+
+# 流式响应的固定响应头，X-Accel-Buffering: no 用于关闭nginx等反向代理的响应缓冲，避免流式输出被攒批
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Content-Type": "text/event-stream",
+    "X-Accel-Buffering": "no",
+}
+SSE_DATA_PREFIX = b"data: "
+
 logger = logging.getLogger("uniapi")
 
 
+def build_sse_error(message):
+    """构建SSE格式的错误消息，使用orjson编码以正确转义消息内容"""
+    return SSE_DATA_PREFIX + orjson.dumps({"error": message}) + CHUNK_SPLITTER
+
+
 class StreamHandler:
     def __init__(self, request, url, headers, body, timeout_seconds, model_request_key=None,
                  current_request_history=None):
@@ -57,7 +73,7 @@ class StreamHandler:
         """解析JSON并提取content和reasoning_content字段"""
         try:
             # 非openAi数据消息，可能为其他心跳包或控制消息，直接返回
-            if not msg.startswith(b'data: '):
+            if not msg.startswith(SSE_DATA_PREFIX):
                 return {'raw_data': msg + CHUNK_SPLITTER}
 
             # 移除SSE前缀 "data: "
@@ -69,8 +85,8 @@ class StreamHandler:
                 return {'raw_data': msg + CHUNK_SPLITTER}
 
             try:
-                json_data = json.loads(data)
-            except json.JSONDecodeError:
+                json_data = orjson.loads(data)
+            except orjson.JSONDecodeError:
                 return {'raw_data': msg + CHUNK_SPLITTER}
 
             if not json_data:
@@ -116,7 +132,7 @@ class StreamHandler:
                 # 检查状态码
                 if not response.is_success:
                     self.upstream_error = True
-                    error_msg = f"data: {{\"error\":\"上游服务器返回错误: {response.status_code}\"}}\n\n".encode()
+                    error_msg = build_sse_error(f"上游服务器返回错误: {response.status_code}")
                     await self.response_queue.put(error_msg)
                     return
 
@@ -125,8 +141,13 @@ class StreamHandler:
 
                 buffer = b""
 
+                # 请求时已要求上游不压缩，直接读取原始字节省去解码层；
+                # 上游仍返回压缩内容时退回到解码读取
+                content_encoding = response.headers.get("content-encoding", "identity")
+                chunks = response.aiter_raw() if content_encoding == "identity" else response.aiter_bytes()
+
                 # 直接逐块读取和处理内容
-                async for chunk in response.aiter_bytes():
+                async for chunk in chunks:
                     if not chunk:  # 跳过空块
                         continue
 
@@ -137,9 +158,14 @@ class StreamHandler:
 
                     buffer += chunk
 
+                    if CHUNK_SPLITTER not in buffer:
+                        continue
+
+                    # 一次切分出所有完整消息，剩余部分留在缓冲区
+                    *messages, buffer = buffer.split(CHUNK_SPLITTER)
+
                     # 解析并提取内容
-                    while CHUNK_SPLITTER in buffer:
-                        msg, buffer = buffer.split(CHUNK_SPLITTER, 1)
+                    for msg in messages:
                         parsed_chunk = self.extract_content_from_chunk(msg)
                         if not parsed_chunk:
                             continue
@@ -155,7 +181,7 @@ class StreamHandler:
         except Exception as e:
             logger.error(f"消费上游响应时出错: {str(e)}", exc_info=True)
             self.upstream_error = True
-            error_msg = f"data: {{\"error\":\"消费上游响应时出错: {str(e)}\"}}\n\n".encode()
+            error_msg = build_sse_error(f"消费上游响应时出错: {str(e)}")
             await self.response_queue.put(error_msg)
         finally:
             self.upstream_complete = True
@@ -226,7 +252,7 @@ class StreamHandler:
                             self.finish_reason_sent = True
                         response["choices"][0]["finish_reason"] = msg_finish_reason
 
-                    responses.append(f"data: {json.dumps(response)}\n\n".encode('utf-8'))
+                    responses.append(SSE_DATA_PREFIX + orjson.dumps(response) + CHUNK_SPLITTER)
 
             return responses
 
@@ -279,7 +305,7 @@ class StreamHandler:
                                 "model": self.current_model,
                                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
                             }
-                            yield f"data: {json.dumps(finish_msg)}\n\n".encode('utf-8')
+                            yield SSE_DATA_PREFIX + orjson.dumps(finish_msg) + CHUNK_SPLITTER
                         yield processed_chunks
                         break
                     yield processed_chunks
@@ -318,15 +344,15 @@ class StreamHandler:
 
         except Exception as e:
             logger.error(f"生成小块时出错: {str(e)}", exc_info=True)
-            error_msg = f"data: {{\"error\":\"生成小块时出错: {str(e)}\"}}\n\n".encode()
+            error_msg = build_sse_error(f"生成小块时出错: {str(e)}")
             yield error_msg
 
     async def process_stream(self):
         """处理流式响应"""
-        client = httpx.AsyncClient(follow_redirects=True, timeout=self.timeout_seconds)
+        client = get_http_client()
 
         # ModelRequestRecord构建
-        self.request_record = ModelRequestRecord(
+        self.request_record = ModelRequestRecord.model_construct(
             request_time=self.request_start_time,
             request_id=str(uuid.uuid4()),
             first_token_rt=-1,
@@ -335,6 +361,7 @@ class StreamHandler:
             request_type="chat",
         )
 
+        consumer_task = None
         try:
             # 创建消费者任务
             consumer_task = asyncio.create_task(self.consume_upstream(client))
@@ -348,25 +375,34 @@ class StreamHandler:
 
         except Exception as e:
             logger.error(f"流式处理出错: {str(e)}", exc_info=True)
-            error_msg = f"data: {{\"error\":\"流式处理出错: {str(e)}\"}}\n\n".encode()
+            error_msg = build_sse_error(f"流式处理出错: {str(e)}")
             yield error_msg
 
         finally:
+            # 下游断开或出错时取消仍在读取上游的任务，退出client.stream()以释放共享连接池中的连接，
+            # 避免上游继续生成无人读取的内容
+            if consumer_task is not None and not consumer_task.done():
+                consumer_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await consumer_task
+
             self.request_record.request_success = True if self.first_token else False
             if not self.first_token:
                 self.request_record.first_token_rt = -1
 
             if self.model_request_key:
-                await record_model_request(self.model_request_key, self.request_record, self.current_request_history)
-            await client.aclose()
+                # 下游断开时Starlette会取消响应，这里的await同样会被取消，写入放到独立任务中并shield，
+                # 保证中断的请求也会计入历史记录
+                record_task = asyncio.create_task(
+                    record_model_request(self.model_request_key, self.request_record, self.current_request_history))
+                _pending_record_tasks.add(record_task)
+                record_task.add_done_callback(_pending_record_tasks.discard)
+                await asyncio.shield(record_task)
 
     def get_response(self):
         """获取StreamingResponse对象"""
         return StreamingResponse(
             self.process_stream(),
             media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Content-Type": "text/event-stream"
-            }
+            headers=SSE_HEADERS
         )
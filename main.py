@@ -2,4 +2,5 @@ import uvicorn
 from api.index import app
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    # uvloop（已安装时）和httptools均为C实现，转发场景下吞吐优于默认的asyncio和h11
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto", http="httptools")